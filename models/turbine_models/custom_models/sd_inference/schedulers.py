@@ -4,6 +4,9 @@
 # See https://llvm.org/LICENSE.txt for license information.
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
+import importlib
+import importlib.metadata
+import io
 import os
 from typing import List
 
@@ -15,23 +18,6 @@ from iree.compiler.ir import Context
 import iree.runtime as ireert
 import numpy as np
 
-from diffusers import (
-    LCMScheduler,
-    LMSDiscreteScheduler,
-    PNDMScheduler,
-    DDPMScheduler,
-    DPMSolverSDEScheduler,
-    DDIMScheduler,
-    DPMSolverMultistepScheduler,
-    KDPM2DiscreteScheduler,
-    EulerDiscreteScheduler,
-    EulerAncestralDiscreteScheduler,
-    DEISMultistepScheduler,
-    DPMSolverSinglestepScheduler,
-    KDPM2AncestralDiscreteScheduler,
-    HeunDiscreteScheduler,
-)
-
 from turbine_models.turbine_tank import turbine_tank
 from turbine_models.custom_models.sd_inference import utils
 from turbine_models.model_runner import vmfbRunner
@@ -87,10 +73,8 @@ class SchedulingModel(torch.nn.Module):
         self.model.is_scale_input_called = True
         self.dtype = dtype
 
-    # TODO: Make steps dynamic here
-    def initialize(self, sample):
-        height = self.height
-        width = self.width
+        # These only depend on construction-time constants, so build them once
+        # here rather than re-deriving them in every traced initialize().
         original_size = (height, width)
         target_size = (height, width)
         crops_coords_top_left = (0, 0)
@@ -99,30 +83,39 @@ class SchedulingModel(torch.nn.Module):
         if self.do_classifier_free_guidance:
             add_time_ids = torch.cat([add_time_ids] * 2, dim=0)
             add_time_ids = add_time_ids.repeat(self.batch_size, 1).type(self.dtype)
-        step_count = torch.tensor(len(self.timesteps))
-        timesteps = self.model.timesteps
+        self._add_time_ids = add_time_ids
+        self._step_count = torch.tensor(len(self.timesteps))
+        self._timesteps = self.model.timesteps.type(torch.float32)
+
+    def _cast(self, tensor):
+        # Dtypes are static while tracing, so only emit a cast op when the
+        # result actually differs from the exported dtype.
+        if tensor.dtype == self.dtype:
+            return tensor
+        return tensor.type(self.dtype)
+
+    # TODO: Make steps dynamic here
+    def initialize(self, sample):
         # ops.trace_tensor("timesteps", self.timesteps)
         sample = sample * self.model.init_noise_sigma
         return (
-            sample.type(self.dtype),
-            add_time_ids,
-            step_count,
-            timesteps.type(torch.float32),
+            self._cast(sample),
+            self._add_time_ids,
+            self._step_count,
+            self._timesteps,
         )
 
     def prepare_model_input(self, sample, i, timesteps):
         t = timesteps[i]
 
-        latent_model_input = sample
-        return self.model.scale_model_input(latent_model_input, t).type(
-            self.dtype
-        ), t.type(self.dtype)
+        latent_model_input = self.model.scale_model_input(sample, t)
+        return self._cast(latent_model_input), self._cast(t)
 
     def step(self, noise_pred, t, sample):
         self.model._step_index = self.model.index_for_timestep(t)
 
         sample = self.model.step(noise_pred, t, sample, return_dict=False)[0]
-        return sample.type(self.dtype)
+        return self._cast(sample)
 
 
 class SharkSchedulerCPUWrapper:
@@ -154,9 +147,20 @@ class SharkSchedulerCPUWrapper:
             torch.float32 if latents_dtype == "float32" else torch.float16
         )
 
+    def _to_torch(self, array):
+        # to_host() already materializes a host copy; wrap it without a second
+        # copy instead of going through torch.tensor(). For host-visible
+        # buffers (local-task/local-sync), to_host() maps the device buffer
+        # rather than copying it, so the result is a view of device memory.
+        if isinstance(array, ireert.DeviceArray):
+            array = array.to_host()
+        if isinstance(array, np.ndarray):
+            array = torch.from_numpy(array)
+        return array
+
     def initialize_sdxl(self, sample, num_inference_steps):
         if isinstance(sample, ireert.DeviceArray):
-            sample = torch.tensor(sample.to_host(), dtype=torch.float32)
+            sample = self._to_torch(sample).type(torch.float32)
 
         self.module.set_timesteps(num_inference_steps)
         self.timesteps = self.module.timesteps
@@ -179,7 +183,7 @@ class SharkSchedulerCPUWrapper:
 
     def initialize_sd(self, sample, num_inference_steps):
         if isinstance(sample, ireert.DeviceArray):
-            sample = torch.tensor(sample.to_host(), dtype=torch.float32)
+            sample = self._to_torch(sample).type(torch.float32)
         self.module.set_timesteps(num_inference_steps)
         timesteps = self.module.timesteps
         sample = sample * self.module.init_noise_sigma
@@ -199,19 +203,20 @@ class SharkSchedulerCPUWrapper:
         return scaled, t
 
     def step(self, noise_pred, t, latents, guidance_scale=None):
-        if isinstance(t, ireert.DeviceArray):
-            t = torch.tensor(t.to_host())
-        if isinstance(noise_pred, ireert.DeviceArray):
-            noise_pred = torch.tensor(noise_pred.to_host())
-        elif isinstance(noise_pred, np.ndarray):
-            noise_pred = torch.tensor(noise_pred)
-        if isinstance(guidance_scale, ireert.DeviceArray):
-            guidance_scale = torch.tensor(guidance_scale.to_host())
+        t = self._to_torch(t)
+        noise_pred = self._to_torch(noise_pred)
+        guidance_scale = self._to_torch(guidance_scale)
+        # The previous step's output is already a host tensor, so across the
+        # denoising loop only a device-resident initial sample is read back.
+        latents = self._to_torch(latents)
         if self.do_guidance:
-            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-            noise_pred = noise_pred_uncond + guidance_scale * (
-                noise_pred_text - noise_pred_uncond
-            )
+            # The batch is laid out as [uncond | cond]; view it as [2, B, ...]
+            # so both halves come from one strided view of the same buffer.
+            noise_pred = noise_pred.view(2, -1, *noise_pred.shape[1:])
+            if isinstance(guidance_scale, torch.Tensor):
+                guidance_scale = guidance_scale.type(noise_pred.dtype)
+            # lerp(a, b, w) == a + w * (b - a), i.e. the CFG combine in one op.
+            noise_pred = torch.lerp(noise_pred[0], noise_pred[1], guidance_scale)
         return self.module.step(
             noise_pred,
             t,
@@ -239,13 +244,10 @@ def export_scheduler_model(
     external_weights: str = None,
     external_weight_path: str = None,
     upload_ir=False,
+    force_rebuild=False,
 ):
     dtype = torch.float16 if precision == "fp16" else torch.float32
     iree_dtype = "float16" if precision == "fp16" else "float32"
-    scheduler = get_scheduler(hf_model_name, scheduler_id)
-    scheduler_module = SchedulingModel(
-        hf_model_name, scheduler, height, width, batch_size, num_inference_steps, dtype
-    )
 
     vmfb_names = [
         scheduler_id + "Scheduler",
@@ -271,6 +273,51 @@ def export_scheduler_model(
         )
         return vmfb_path
 
+    # Repeated exports of the same configuration are served from disk. The MLIR
+    # is keyed independently of the target so it can be reused across devices.
+    # The diffusers version and this file's source are part of the key, so
+    # changes to the scheduler or tracing code invalidate cached artifacts.
+    import_to = "INPUT" if compile_to == "linalg" else "IMPORT"
+    with open(__file__, "rb") as f:
+        scheduler_source = f.read()
+    mlir_key = utils.get_artifact_cache_key(
+        importlib.metadata.version("diffusers"),
+        scheduler_source,
+        scheduler_id,
+        hf_model_name,
+        batch_size,
+        height,
+        width,
+        num_inference_steps,
+        precision,
+        import_to,
+    )
+    vmfb_key = utils.get_artifact_cache_key(mlir_key, target, ireec_flags)
+    if not force_rebuild and compile_to == "vmfb":
+        vmfb_path = utils.get_cached_artifact(pipeline_dir, vmfb_key)
+        if vmfb_path:
+            print("Found cached scheduler vmfb:", vmfb_path)
+            return vmfb_path
+        mlir_path = utils.get_cached_artifact(pipeline_dir, mlir_key)
+        if mlir_path:
+            print("Found cached scheduler MLIR:", mlir_path)
+            vmfb_path = utils.compile_to_vmfb(
+                mlir_path,
+                device,
+                target,
+                ireec_flags,
+                safe_name,
+                mlir_source="file",
+                return_path=True,
+            )
+            utils.cache_artifact(pipeline_dir, vmfb_key, vmfb_path)
+            return vmfb_path
+
+    scheduler = get_scheduler(hf_model_name, scheduler_id)
+    scheduler_module = SchedulingModel(
+        hf_model_name, scheduler, height, width, batch_size, num_inference_steps, dtype
+    )
+
     sample = (
         batch_size,
         4,
@@ -283,6 +330,10 @@ def export_scheduler_model(
         height // 8,
         width // 8,
     )
+    # The example inputs must be real CPU tensors, not meta tensors: step()
+    # calls index_for_timestep(t), which compares t with the scheduler's CPU
+    # timesteps, and several schedulers index CPU alphas_cumprod/sigmas with
+    # the result. FakeTensor rejects that meta-vs-CPU device mixing.
     example_init_args = [torch.empty(sample, dtype=dtype)]
     example_prep_args = (
         torch.empty(sample, dtype=dtype),
@@ -301,6 +352,17 @@ def export_scheduler_model(
         torch.empty(sample, dtype=dtype),
     ]
 
+    if compile_to == "aoti":
+        aoti_args = {
+            "run_initialize": example_init_args,
+            "run_scale": [
+                *example_prep_args[:2],
+                torch.empty([len(scheduler_module.timesteps)], dtype=torch.float32),
+            ],
+            "run_step": example_step_args,
+        }
+        return export_scheduler_aoti(scheduler_module, aoti_args, safe_name)
+
     fxb = FxProgramsBuilder(scheduler_module)
 
     @fxb.export_program(
@@ -340,7 +402,6 @@ def export_scheduler_model(
             run_scale = _scale
             run_step = _step
 
-    import_to = "INPUT" if compile_to == "linalg" else "IMPORT"
     inst = CompiledScheduler(context=Context(), import_to=import_to)
 
     module = CompiledModule.get_mlir_module(inst)
@@ -365,30 +426,70 @@ def export_scheduler_model(
     module = AddMetadataPass(module, model_metadata_init, "run_initialize").run()
     module = AddMetadataPass(module, model_metadata_prep, "run_scale").run()
     module = AddMetadataPass(module, model_metadata_step, "run_step").run()
-    module_str = str(module)
     if compile_to != "vmfb":
-        return module_str
+        return str(module)
     elif compile_to == "vmfb":
+        module_bytecode = io.BytesIO()
+        module.operation.write_bytecode(module_bytecode)
         vmfb = utils.compile_to_vmfb(
-            module_str,
+            module_bytecode.getvalue(),
             device,
             target,
             ireec_flags,
             safe_name,
+            mlir_source="bytecode",
             return_path=True,
         )
+        if os.path.exists(safe_name + ".mlirbc"):
+            utils.cache_artifact(pipeline_dir, mlir_key, safe_name + ".mlirbc")
+        utils.cache_artifact(pipeline_dir, vmfb_key, vmfb)
         return vmfb
 
 
+class _SchedulingModelMethod(torch.nn.Module):
+    def __init__(self, scheduler_module, method_name):
+        super().__init__()
+        self.scheduler_module = scheduler_module
+        self.method_name = method_name
+
+    def forward(self, *inputs):
+        return getattr(self.scheduler_module, self.method_name)(*inputs)
+
+
+def export_scheduler_aoti(scheduler_module, example_args, safe_name):
+    # Ahead-of-time compiles each scheduler entrypoint to a shared library with
+    # TorchInductor, for CPU scheduling without Python dispatch per step.
+    # Returns a dict of entrypoint name -> .so path; each can be loaded with
+    # torch._export.aot_load.
+    method_names = {
+        "run_initialize": "initialize",
+        "run_scale": "prepare_model_input",
+        "run_step": "step",
+    }
+    so_paths = {}
+    for name, method_name in method_names.items():
+        args = tuple(example_args[name])
+        ep = torch.export.export(
+            _SchedulingModelMethod(scheduler_module, method_name), args=args
+        )
+        so_paths[name] = torch._inductor.aot_compile(
+            ep.module(),
+            args,
+            options={"aot_inductor.output_path": f"{safe_name}_{name}.so"},
+        )
+        print("Saved to", so_paths[name])
+    return so_paths
+
+
 def get_scheduler(model_id, scheduler_id):
     # TODO: switch over to turbine and run all on GPU
     print(f"\n[LOG] Initializing schedulers from model id: {model_id}")
     if scheduler_id in SCHEDULER_MAP.keys():
-        scheduler = SCHEDULER_MAP[scheduler_id].from_pretrained(
+        scheduler = _get_scheduler_class(scheduler_id).from_pretrained(
             model_id, subfolder="scheduler"
         )
     elif all(x in scheduler_id for x in ["DPMSolverMultistep", "++"]):
-        scheduler = DPMSolverMultistepScheduler.from_pretrained(
+        scheduler = _get_scheduler_class("DPMSolverMultistep").from_pretrained(
             model_id, subfolder="scheduler", algorithm_type="dpmsolver++"
         )
     else:
@@ -399,25 +500,33 @@ def get_scheduler(model_id, scheduler_id):
     return scheduler
 
 
+# Scheduler classes are resolved on first use so that importing this module
+# doesn't pay for importing every diffusers scheduler.
 SCHEDULER_MAP = {
-    "PNDM": PNDMScheduler,
-    "DDPM": DDPMScheduler,
-    "KDPM2Discrete": KDPM2DiscreteScheduler,
-    "LMSDiscrete": LMSDiscreteScheduler,
-    "DDIM": DDIMScheduler,
-    "LCMScheduler": LCMScheduler,
-    "EulerDiscrete": EulerDiscreteScheduler,
-    "EulerAncestralDiscrete": EulerAncestralDiscreteScheduler,
-    "DEISMultistep": DEISMultistepScheduler,
-    "DPMSolverSinglestep": DPMSolverSinglestepScheduler,
-    "KDPM2AncestralDiscrete": KDPM2AncestralDiscreteScheduler,
-    "HeunDiscrete": HeunDiscreteScheduler,
-    "DPMSolverMultistepKarras": DPMSolverMultistepScheduler,
-    "DPMSolverMultistep": DPMSolverMultistepScheduler,
-    "DPMSolverSDE": DPMSolverSDEScheduler,
-    "DPMSolverSDEKarras": DPMSolverSDEScheduler,
+    "PNDM": ("diffusers", "PNDMScheduler"),
+    "DDPM": ("diffusers", "DDPMScheduler"),
+    "KDPM2Discrete": ("diffusers", "KDPM2DiscreteScheduler"),
+    "LMSDiscrete": ("diffusers", "LMSDiscreteScheduler"),
+    "DDIM": ("diffusers", "DDIMScheduler"),
+    "LCMScheduler": ("diffusers", "LCMScheduler"),
+    "EulerDiscrete": ("diffusers", "EulerDiscreteScheduler"),
+    "EulerAncestralDiscrete": ("diffusers", "EulerAncestralDiscreteScheduler"),
+    "DEISMultistep": ("diffusers", "DEISMultistepScheduler"),
+    "DPMSolverSinglestep": ("diffusers", "DPMSolverSinglestepScheduler"),
+    "KDPM2AncestralDiscrete": ("diffusers", "KDPM2AncestralDiscreteScheduler"),
+    "HeunDiscrete": ("diffusers", "HeunDiscreteScheduler"),
+    "DPMSolverMultistepKarras": ("diffusers", "DPMSolverMultistepScheduler"),
+    "DPMSolverMultistep": ("diffusers", "DPMSolverMultistepScheduler"),
+    "DPMSolverSDE": ("diffusers", "DPMSolverSDEScheduler"),
+    "DPMSolverSDEKarras": ("diffusers", "DPMSolverSDEScheduler"),
 }
 
+
+def _get_scheduler_class(scheduler_id):
+    module_name, class_name = SCHEDULER_MAP[scheduler_id]
+    return getattr(importlib.import_module(module_name), class_name)
+
+
 if __name__ == "__main__":
     from turbine_models.custom_models.sd_inference.sd_cmd_opts import args
 
@@ -435,6 +544,7 @@ if __name__ == "__main__":
         args.ireec_flags,
         exit_on_vmfb=False,
         input_mlir=args.input_mlir,
+        force_rebuild=args.force_rebuild,
     )
     vmfb_names = [
         args.scheduler_id + "Scheduler",
@@ -444,7 +554,7 @@ if __name__ == "__main__":
         args.iree_target_triple,
     ]
     safe_name = "_".join(vmfb_names)
-    if args.compile_to != "vmfb":
+    if args.compile_to not in ["vmfb", "aoti"]:
         with open(f"{safe_name}.mlir", "w+") as f:
             f.write(mod_str)
         print("Saved to", safe_name + ".mlir")
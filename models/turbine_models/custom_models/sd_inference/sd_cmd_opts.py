@@ -130,6 +130,13 @@ p.add_argument(
     help="Directory to save pipeline artifacts",
 )
 
+p.add_argument(
+    "--force_rebuild",
+    default=False,
+    action="store_true",
+    help="Re-export and recompile artifacts even if cached copies exist.",
+)
+
 p.add_argument(
     "--compiled_pipeline",
     default=False,
@@ -275,7 +282,9 @@ p.add_argument(
 # SDXL script general options.
 ##############################################################################
 
-p.add_argument("--compile_to", type=str, default="mlir", help="torch, linalg, vmfb")
+p.add_argument(
+    "--compile_to", type=str, default="mlir", help="torch, linalg, vmfb, aoti"
+)
 
 p.add_argument("--verbose", "-v", action="store_true")
 p.add_argument(
@@ -2,16 +2,11 @@ from urllib.request import urlopen
 import iree.compiler as ireec
 import numpy as np
 import os
+import hashlib
+import json
 import safetensors
 import safetensors.numpy as safe_numpy
-import re
 import glob
-from diffusers import (
-    PNDMScheduler,
-    EulerDiscreteScheduler,
-    EulerAncestralDiscreteScheduler,
-    # DPMSolverSDEScheduler,
-)
 
 # If flags are verified to work on a specific model and improve performance without regressing numerics, add them to this dictionary. If you are working with bleeding edge flags, please add them manually with the --ireec_flags argument.
 MI_flags = {
@@ -353,7 +348,7 @@ def compile_to_vmfb(
     # the TD spec is implemented in C++.
 
     if attn_spec in ["default", "mfma", "punet"]:
-#        if any(x in safe_name for x in ["clip", "prompt_encoder"]) == False:
+        #        if any(x in safe_name for x in ["clip", "prompt_encoder"]) == False:
         use_punet = True if attn_spec in ["punet", "i8"] else False
         attn_spec = get_mfma_spec_path(
             target_triple,
@@ -373,24 +368,7 @@ def compile_to_vmfb(
         if any(x in safe_name for x in ["clip", "prompt_encoder"]) == False:
             flags.extend(["--iree-codegen-transform-dialect-library=" + attn_spec])
 
-    for i, flag in enumerate(ireec_flags):
-        k = flag.strip().split("=")[0]
-        for idx, default in enumerate(flags):
-            if default == None:
-                flags.pop(idx)
-                continue
-            elif k == default.split("=")[0]:
-                flags[idx] = flag if flag.split("=")[-1] not in ["None", ""] else None
-                flag = None
-                if flags[idx] == None:
-                    flags.pop(idx)
-                continue
-        if flag not in [None, "", " "] and flag.split("=")[-1] not in ["None", ""]:
-            flags.append(flag)
-
-    for idx, flag in enumerate(flags):
-        if flag is None:
-            flags.pop(idx)
+    flags = merge_ireec_flags(flags, ireec_flags)
     input_ir_type = "torch"
     if add_tk_kernels:
         print("Adding tk kernels")
@@ -402,7 +380,7 @@ def compile_to_vmfb(
                 input_type=input_ir_type,
                 extra_args=flags,
             )
-        elif mlir_source == "str":
+        elif mlir_source in ["str", "bytecode"]:
             flatbuffer_blob = ireec.compile_str(
                 module_str,
                 target_backends=[device],
@@ -449,15 +427,58 @@ def compile_to_vmfb(
             input_type=input_ir_type,
             extra_args=flags,
         )
+    elif mlir_source == "bytecode":
+        # module_str holds MLIR bytecode, which skips printing and re-parsing
+        # the textual IR.
+        if save_mlir:
+            with open(f"{safe_mlir_name}.mlirbc", "wb") as f:
+                f.write(module_str)
+            print("Saved to", safe_mlir_name + ".mlirbc")
+        flatbuffer_blob = ireec.compile_str(
+            module_str,
+            target_backends=[device],
+            input_type=input_ir_type,
+            extra_args=flags,
+        )
     else:
-        raise ValueError("mlir_source must be either 'file' or 'str'")
-    with open(f"{safe_vmfb_name}.vmfb", "wb+") as f:
-        f.write(flatbuffer_blob)
+        raise ValueError("mlir_source must be one of 'file', 'str' or 'bytecode'")
+    write_vmfb(f"{safe_vmfb_name}.vmfb", flatbuffer_blob)
     print(f"Saved to {safe_vmfb_name}.vmfb")
     if return_path == True:
         return safe_vmfb_name + ".vmfb"
 
 
+def merge_ireec_flags(default_flags, user_flags):
+    # User flags override defaults with the same key; a value of "None" or ""
+    # drops the default entirely.
+    flag_by_key = {flag.split("=")[0]: flag for flag in default_flags if flag}
+    for flag in user_flags:
+        flag = flag.strip()
+        if not flag:
+            continue
+        k = flag.split("=")[0]
+        if flag.split("=")[-1] in ["None", ""]:
+            flag_by_key.pop(k, None)
+        else:
+            flag_by_key[k] = flag
+    return list(flag_by_key.values())
+
+
+def write_vmfb(vmfb_path, flatbuffer_blob):
+    # Writes straight to the file descriptor so multi-hundred-MB flatbuffers
+    # aren't copied through Python's buffered I/O layer.
+    blob = memoryview(flatbuffer_blob)
+    fd = os.open(vmfb_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while blob:
+            blob = blob[os.write(fd, blob) :]
+    finally:
+        os.close(fd)
+
+
+_SAFE_NAME_TABLE = str.maketrans({"-": "_", ".": "_"})
+
+
 def create_safe_name(hf_model_name, model_name_str=""):
     if not model_name_str:
         model_name_str = ""
@@ -465,9 +486,55 @@ def create_safe_name(hf_model_name, model_name_str=""):
         model_name_str = "_" + model_name_str
 
     safe_name = hf_model_name.split("/")[-1].strip() + model_name_str
-    safe_name = re.sub("-", "_", safe_name)
-    safe_name = re.sub("\.", "_", safe_name)
-    return safe_name
+    return safe_name.translate(_SAFE_NAME_TABLE)
+
+
+def get_artifact_cache_key(*key_parts):
+    # Parts are hashed incrementally so large ones (e.g. a module's IR) aren't
+    # copied into one joined string first.
+    key_hash = hashlib.sha256()
+    for part in key_parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode("utf-8")
+        key_hash.update(part)
+        key_hash.update(b"|")
+    return key_hash.hexdigest()
+
+
+def _get_artifact_cache_index(cache_dir):
+    return os.path.join(cache_dir if cache_dir else ".", "artifact_cache.json")
+
+
+def get_cached_artifact(cache_dir, key):
+    # Returns the path of a previously exported artifact matching key, if it
+    # is still present on disk.
+    index_path = _get_artifact_cache_index(cache_dir)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as f:
+        index = json.load(f)
+    artifact_path = index.get(key)
+    if artifact_path and os.path.exists(artifact_path):
+        return artifact_path
+    return None
+
+
+def cache_artifact(cache_dir, key, artifact_path):
+    index_path = _get_artifact_cache_index(cache_dir)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    # A rebuild overwrites the artifact in place, so entries for other keys
+    # pointing at the same path are stale.
+    index = {k: path for k, path in index.items() if path != artifact_path}
+    index[key] = artifact_path
+    # Replace the index atomically so concurrent exports never leave a
+    # truncated file behind; at worst one of their entries is lost.
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
 
 
 def get_mfma_spec_path(target_chip, save_dir, masked_attention=False, use_punet=False):
@@ -525,7 +592,15 @@ def save_external_weights(
             if vae_harness:
                 mod_params = vae_params
             if external_weight_file and not os.path.isfile(external_weight_file):
+                # Save the tensors as they are in the model (already cast to
+                # the export dtype), without grad state or odd strides.
+                mod_params = {
+                    name: tensor.detach().contiguous()
+                    for name, tensor in mod_params.items()
+                }
                 if not force_format:
+                    import safetensors.torch
+
                     safetensors.torch.save_file(mod_params, external_weight_file)
                 else:
                     for x in mod_params.keys():
@@ -535,13 +610,23 @@ def save_external_weights(
 
 
 def largest_error(array1, array2):
-    absolute_diff = np.abs(array1 - array2)
+    # Take the absolute value in place so only one temporary the size of the
+    # inputs is materialized.
+    absolute_diff = np.asarray(np.subtract(array1, array2))
+    np.abs(absolute_diff, out=absolute_diff)
     max_error = np.max(absolute_diff)
     print("Max error:", max_error)
     return max_error
 
 
 def get_schedulers(model_id):
+    from diffusers import (
+        PNDMScheduler,
+        EulerDiscreteScheduler,
+        EulerAncestralDiscreteScheduler,
+        # DPMSolverSDEScheduler,
+    )
+
     # TODO: Robust scheduler setup on pipeline creation -- if we don't
     # set batch_size here, the SHARK schedulers will
     # compile with batch size = 1 regardless of whether the model
@@ -1,4 +1,5 @@
 import argparse
+import functools
 from turbine_models.model_runner import vmfbRunner
 from transformers import CLIPTokenizer
 from iree import runtime as ireert
@@ -6,6 +7,35 @@ import torch
 import numpy as np
 
 
+@functools.lru_cache(maxsize=8)
+def _get_tokenizer(hf_model_name, subfolder, hf_auth_token):
+    return CLIPTokenizer.from_pretrained(
+        hf_model_name,
+        subfolder=subfolder,
+        token=hf_auth_token,
+    )
+
+
+@functools.lru_cache(maxsize=64)
+def _tokenize(hf_model_name, subfolder, hf_auth_token, prompt, max_length):
+    # Cached as nested tuples so callers can't mutate a shared result.
+    tokenizer = _get_tokenizer(hf_model_name, subfolder, hf_auth_token)
+    text_input = tokenizer(
+        prompt,
+        padding="max_length",
+        max_length=max_length,
+        truncation=True,
+        return_tensors="pt",
+    )
+    return tuple(tuple(ids) for ids in text_input.input_ids.tolist())
+
+
+def get_input_ids(hf_model_name, subfolder, hf_auth_token, prompt, max_length):
+    return torch.tensor(
+        _tokenize(hf_model_name, subfolder, hf_auth_token, prompt, max_length)
+    )
+
+
 def run_encode_prompts(
     device,
     prompt,
@@ -22,16 +52,8 @@ def run_encode_prompts(
     runner_2 = vmfbRunner(device, vmfb_path_2, external_weight_path_2)
     text_encoders = [runner_1, runner_2]
 
-    tokenizer_1 = CLIPTokenizer.from_pretrained(
-        hf_model_name,
-        subfolder="tokenizer",
-        token=hf_auth_token,
-    )
-    tokenizer_2 = CLIPTokenizer.from_pretrained(
-        hf_model_name,
-        subfolder="tokenizer_2",
-        token=hf_auth_token,
-    )
+    tokenizer_1 = _get_tokenizer(hf_model_name, "tokenizer", hf_auth_token)
+    tokenizer_2 = _get_tokenizer(hf_model_name, "tokenizer_2", hf_auth_token)
     tokenizers = [tokenizer_1, tokenizer_2]
     prompt_embeds_list = []
     prompts = [prompt, prompt]
@@ -129,32 +151,12 @@ def run_torch_clip(hf_model_name, hf_auth_token, prompt, max_length=64):
 
     model_1 = ClipModel(hf_model_name, hf_auth_token, index=1)
     model_2 = ClipModel(hf_model_name, hf_auth_token, index=2)
-    tokenizer_1 = CLIPTokenizer.from_pretrained(
-        hf_model_name,
-        subfolder="tokenizer",
-        token=hf_auth_token,
-    )
-    tokenizer_2 = CLIPTokenizer.from_pretrained(
-        hf_model_name,
-        subfolder="tokenizer_2",
-        token=hf_auth_token,
+    example_input_1 = get_input_ids(
+        hf_model_name, "tokenizer", hf_auth_token, prompt, max_length
     )
-    text_input_1 = tokenizer_1(
-        prompt,
-        padding="max_length",
-        max_length=max_length,
-        truncation=True,
-        return_tensors="pt",
+    example_input_2 = get_input_ids(
+        hf_model_name, "tokenizer_2", hf_auth_token, prompt, max_length
     )
-    text_input_2 = tokenizer_2(
-        prompt,
-        padding="max_length",
-        max_length=max_length,
-        truncation=True,
-        return_tensors="pt",
-    )
-    example_input_1 = text_input_1.input_ids
-    example_input_2 = text_input_2.input_ids
 
     results_1 = model_1.forward(example_input_1)
     results_2 = model_2.forward(example_input_2)
@@ -176,29 +178,16 @@ def run_clip(
     runner = vmfbRunner(device, vmfb_path, external_weight_path)
 
     if index == 1:
-        tokenizer = CLIPTokenizer.from_pretrained(
-            hf_model_name,
-            subfolder="tokenizer",
-            token=hf_auth_token,
-        )
+        subfolder = "tokenizer"
     elif index == 2:
-        tokenizer = CLIPTokenizer.from_pretrained(
-            hf_model_name,
-            subfolder="tokenizer_2",
-            token=hf_auth_token,
-        )
+        subfolder = "tokenizer_2"
     else:
         print("Incorrect CLIP model index, please use 1 or 2")
         exit(1)
 
-    text_input = tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=max_length,
-        truncation=True,
-        return_tensors="pt",
+    example_input = get_input_ids(
+        hf_model_name, subfolder, hf_auth_token, prompt, max_length
     )
-    example_input = text_input.input_ids
     inp = [ireert.asdevicearray(runner.config.device, example_input)]
     results = runner.ctx.modules.compiled_clip["main"](*inp)
 
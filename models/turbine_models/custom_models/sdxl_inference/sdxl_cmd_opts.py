@@ -151,6 +151,13 @@ p.add_argument(
     help="Directory to save pipeline artifacts",
 )
 
+p.add_argument(
+    "--force_rebuild",
+    default=False,
+    action="store_true",
+    help="Re-export and recompile artifacts even if cached copies exist.",
+)
+
 p.add_argument(
     "--compiled_pipeline",
     default=False,
@@ -162,7 +169,7 @@ p.add_argument(
     "--vae_precision",
     type=str,
     default="fp16",
-    help="Precision of VAE weights and graph.",
+    help="Precision of VAE weights and graph. One of fp32, fp16, bf16 or fp8 (gfx942 and sm_90a only).",
 )
 
 p.add_argument(
@@ -244,7 +251,12 @@ p.add_argument(
 p.add_argument(
     "--max_length", type=int, default=64, help="Sequence Length of Stable Diffusion"
 )
-p.add_argument("--vae_variant", type=str, default="decode", help="encode, decode")
+p.add_argument(
+    "--vae_variant",
+    type=str,
+    default="decode",
+    help="encode, decode, decode_tiled, encode_decode, preview, all. When exporting, several comma-separated variants are exported in parallel.",
+)
 p.add_argument(
     "--return_index",
     action="store_true",
@@ -69,6 +69,7 @@ class SharkSDXLPipeline:
         cpu_scheduling: bool = False,
         vae_precision: str = "fp32",
         batch_prompt_input: bool = False,
+        force_rebuild: bool = False,
     ):
         self.hf_model_name = hf_model_name
         self.scheduler_id = scheduler_id
@@ -118,8 +119,9 @@ class SharkSDXLPipeline:
         self.external_weights = external_weights
         self.vae_decomp_attn = vae_decomp_attn
         self.vae_precision = vae_precision
-        self.vae_dtype = "float32" if vae_precision == "fp32" else "float16"
+        self.vae_dtype = "float16" if vae_precision == "fp16" else "float32"
         self.custom_vae = custom_vae
+        self.force_rebuild = force_rebuild
         if self.custom_vae:
             self.vae_dir = os.path.join(
                 self.pipeline_dir, utils.create_safe_name(custom_vae, "")
@@ -437,10 +439,13 @@ class SharkSDXLPipeline:
                         exit_on_vmfb=False,
                         pipeline_dir=self.pipeline_dir,
                         input_mlir=None,
+                        force_rebuild=self.force_rebuild,
                     )
                     return scheduler_vmfb, None
             case "vae_decode":
-                if not input_mlir[submodel]:
+                # For weights-only exports, export_vae_model builds the model
+                # itself and rewrites the weights file if it is stale.
+                if not input_mlir[submodel] and not weights_only:
                     vae_torch = self.get_torch_models("vae_decode")
                 else:
                     vae_torch = None
@@ -472,6 +477,12 @@ class SharkSDXLPipeline:
                     attn_spec=self.attn_spec,
                     input_mlir=input_mlir["vae_decode"],
                     weights_only=weights_only,
+                    custom_vae=(
+                        "madebyollin/sdxl-vae-fp16-fix"
+                        if self.vae_precision == "fp16"
+                        else self.custom_vae
+                    ),
+                    force_rebuild=self.force_rebuild,
                 )
                 del vae_torch
                 return vae_decode_vmfb, vae_external_weight_path
@@ -1086,6 +1097,7 @@ if __name__ == "__main__":
         custom_vae=None,
         vae_precision=args.vae_precision,
         batch_prompt_input=args.batch_prompt_input,
+        force_rebuild=args.force_rebuild,
     )
 
     vmfbs, weights = sdxl_pipe.check_prepared(mlirs, vmfbs, weights)
@@ -4,7 +4,7 @@
 # See https://llvm.org/LICENSE.txt for license information.
 # SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
 
-import copy
+import io
 import os
 import sys
 
@@ -17,9 +17,25 @@ from shark_turbine.dynamo.passes import (
 )
 from turbine_models.custom_models.sd_inference import utils
 import torch
-import torch._dynamo as dynamo
-from diffusers import AutoencoderKL
-import safetensors
+
+# Tile size for the decode_tiled variant. diffusers' default only tiles
+# latents larger than the model's sample size (1024px for SDXL), which would
+# leave native-resolution decodes monolithic.
+_VAE_TILE_SAMPLE_SIZE = 512
+
+
+def enable_vae_tiling(vae, tile_sample_size=_VAE_TILE_SAMPLE_SIZE):
+    # Decode large latents in overlapping tiles, one batch element at a time,
+    # to cap peak activation memory.
+    vae.enable_tiling()
+    vae.enable_slicing()
+    if hasattr(vae, "tile_latent_min_size"):
+        # diffusers' 0.25 overlap factor is kept, so neighbouring tiles are
+        # blended over a quarter of the tile size.
+        downscale = 2 ** (len(vae.config.block_out_channels) - 1)
+        vae.tile_sample_min_size = tile_sample_size
+        vae.tile_latent_min_size = tile_sample_size // downscale
+    return vae
 
 
 class VaeModel(torch.nn.Module):
@@ -27,20 +43,35 @@ class VaeModel(torch.nn.Module):
         self,
         hf_model_name,
         custom_vae="",
+        tile=False,
     ):
         super().__init__()
+        # diffusers is imported here rather than at module scope so that
+        # compiling from existing MLIR doesn't pay for importing it.
+        from diffusers import AutoencoderKL
+
         self.vae = None
-        if custom_vae in ["", None]:
+        self.is_tiny = False
+        if custom_vae == "taesdxl":
+            from diffusers import AutoencoderTiny
+
+            # Distilled preview-quality autoencoder with the same latent and
+            # image shapes as the full SDXL VAE.
+            self.vae = AutoencoderTiny.from_pretrained("madebyollin/taesdxl")
+            self.is_tiny = True
+        elif custom_vae in ["", None]:
             self.vae = AutoencoderKL.from_pretrained(
                 hf_model_name,
                 subfolder="vae",
             )
         elif "safetensors" in custom_vae:
+            import safetensors.torch
+
             custom_vae = safetensors.torch.load_file(custom_vae)
-            # custom vae as a HF state dict
-            self.vae = AutoencoderKL.from_pretrained(
-                hf_model_name,
-                subfolder="vae",
+            # custom vae as a HF state dict; only the base model's config is
+            # needed since all of its weights are replaced.
+            self.vae = AutoencoderKL.from_config(
+                AutoencoderKL.load_config(hf_model_name, subfolder="vae")
             )
             self.vae.load_state_dict(custom_vae)
         elif not isinstance(custom_vae, dict):
@@ -55,15 +86,130 @@ class VaeModel(torch.nn.Module):
                     custom_vae,
                     subfolder="vae",
                 )
+        if tile:
+            enable_vae_tiling(self.vae)
 
+    @property
+    def compute_dtype(self):
+        # fp8-quantized layers store float8 weights, so the activation dtype is
+        # that of the first parameter that isn't one of those.
+        return next(
+            param.dtype
+            for param in self.vae.parameters()
+            if param.dtype != torch.float8_e4m3fn
+        )
+
+    # A bf16 decoder body takes and returns fp32 tensors (numpy has no
+    # bfloat16), with the latent scaling and the [-1, 1] -> [0, 1] rescale
+    # done in fp32 around it to avoid bf16 precision loss on those ranges.
+    # Other precisions keep their own dtype at the boundary.
+    # AutoencoderTiny works on unscaled latents, so it skips the 0.13025 factor.
     def decode(self, inp):
-        img = 1 / 0.13025 * inp
+        dtype = self.compute_dtype
+        upcast = dtype == torch.bfloat16
+        if self.is_tiny:
+            img = inp.to(dtype)
+        elif upcast:
+            img = inp.float().mul(1 / 0.13025).to(dtype)
+        else:
+            img = inp.mul(1 / 0.13025)
         x = self.vae.decode(img, return_dict=False)[0]
-        return (x / 2 + 0.5).clamp(0, 1)
+        if upcast:
+            x = x.float()
+        # Chained in-place on the decoder output so the rescale is a single
+        # epilogue on the last conv's result.
+        return x.mul_(0.5).add_(0.5).clamp_(0, 1)
 
     def encode(self, inp):
-        latents = self.vae.encode(inp).latent_dist.sample()
-        return 0.13025 * latents
+        dtype = self.compute_dtype
+        inp = inp.to(dtype)
+        if self.is_tiny:
+            latents = self.vae.encode(inp).latents
+        else:
+            latents = self.vae.encode(inp).latent_dist.sample()
+        if dtype == torch.bfloat16:
+            latents = latents.float()
+        return latents if self.is_tiny else 0.13025 * latents
+
+
+# Unless decomp_attn is requested, aten.scaled_dot_product_attention is left
+# intact so it reaches IREE as a single attention op. On CPU the CPU-specific
+# flash attention variant is always decomposed.
+_CPU_DECOMP_OPS = (torch.ops.aten._scaled_dot_product_flash_attention_for_cpu,)
+_ATTN_DECOMP_OPS = _CPU_DECOMP_OPS + (
+    torch.ops.aten._scaled_dot_product_flash_attention.default,
+    torch.ops.aten.scaled_dot_product_attention,
+)
+
+# Targets with native fp8 (e4m3) support.
+_FP8_TARGETS = ("gfx942", "sm_90a")
+
+
+class Fp8WeightLayer(torch.nn.Module):
+    """Conv2d/Linear replacement that stores its weight as float8_e4m3fn with a
+    per-tensor scale and upcasts it to the activation dtype on the fly."""
+
+    def __init__(self, layer):
+        super().__init__()
+        fp8_max = torch.finfo(torch.float8_e4m3fn).max
+        weight = layer.weight.detach().float()
+        # The scale is kept in the layer's own dtype so that the first
+        # non-fp8 parameter still reports the activation dtype.
+        scale = (weight.abs().amax().clamp(min=1e-12) / fp8_max).to(layer.weight.dtype)
+        weight = (weight / scale.float()).clamp(-fp8_max, fp8_max)
+        # Parameters rather than buffers, so externalize_module_parameters
+        # moves them to the external weights file too.
+        self.weight = torch.nn.Parameter(
+            weight.to(torch.float8_e4m3fn), requires_grad=False
+        )
+        self.scale = torch.nn.Parameter(scale, requires_grad=False)
+        self.bias = (
+            torch.nn.Parameter(layer.bias.detach(), requires_grad=False)
+            if layer.bias is not None
+            else None
+        )
+        self.is_conv = isinstance(layer, torch.nn.Conv2d)
+        if self.is_conv:
+            self.stride = layer.stride
+            self.padding = layer.padding
+            self.dilation = layer.dilation
+            self.groups = layer.groups
+
+    # Extra positional args (e.g. the LoRA scale some diffusers layers are
+    # called with) are ignored.
+    def forward(self, x, *args):
+        weight = self.weight.to(x.dtype) * self.scale.to(x.dtype)
+        if self.is_conv:
+            return torch.nn.functional.conv2d(
+                x,
+                weight,
+                self.bias,
+                self.stride,
+                self.padding,
+                self.dilation,
+                self.groups,
+            )
+        return torch.nn.functional.linear(x, weight, self.bias)
+
+
+def quantize_weights_fp8(module):
+    for name, child in module.named_children():
+        if isinstance(child, (torch.nn.Conv2d, torch.nn.Linear)):
+            setattr(module, name, Fp8WeightLayer(child))
+        else:
+            quantize_weights_fp8(child)
+    return module
+
+
+def _external_weights_current(vae_model, external_weight_path):
+    # Treat an existing weights file as current if its size matches the
+    # model's tensors plus a small allowance for the format header.
+    if not os.path.exists(external_weight_path):
+        return False
+    tensors = [*vae_model.parameters(), *vae_model.buffers()]
+    expected_size = sum(t.numel() * t.element_size() for t in tensors)
+    header_size = os.path.getsize(external_weight_path) - expected_size
+    return 0 <= header_size < 2**20
 
 
 def export_vae_model(
@@ -86,7 +232,20 @@ def export_vae_model(
     attn_spec=None,
     input_mlir=None,
     weights_only=False,
+    custom_vae="",
+    force_rebuild=False,
 ):
+    # Keeps the latent and conv shapes aligned to the GPU matmul intrinsics
+    # instead of relying on IREE's padding fallback.
+    if height % 64 != 0 or width % 64 != 0:
+        raise ValueError(
+            f"VAE export requires height and width divisible by 64, got {height}x{width}"
+        )
+    if variant == "decode_tiled" and max(height, width) <= _VAE_TILE_SAMPLE_SIZE:
+        raise ValueError(
+            f"decode_tiled needs a height or width above {_VAE_TILE_SAMPLE_SIZE} "
+            f"to split the decode into tiles, got {height}x{width}"
+        )
     safe_name = utils.create_safe_name(
         hf_model_name,
         f"_bs{batch_size}_{height}x{width}_{precision}_vae_{variant}",
@@ -94,6 +253,9 @@ def export_vae_model(
     if pipeline_dir:
         safe_name = os.path.join(pipeline_dir, safe_name)
 
+    # The VAE deliberately adds no IREE flags of its own (e.g. forcing
+    # --iree-opt-const-eval on): the per-target flag tables in utils.py turn
+    # const-eval off on purpose, and user flags would override them anyway.
     if input_mlir:
         vmfb_path = utils.compile_to_vmfb(
             input_mlir,
@@ -106,126 +268,266 @@ def export_vae_model(
             attn_spec=attn_spec,
         )
         return vmfb_path
+
+    # The model is built lazily when not passed in. Weights-only runs build
+    # it too, so an existing weights file is always checked for staleness.
+    if vae_model is None:
+        if variant == "preview" and not custom_vae:
+            custom_vae = "taesdxl"
+        vae_model = VaeModel(
+            hf_model_name, custom_vae=custom_vae, tile=variant == "decode_tiled"
+        )
+
     # if precision == "fp32" and device == "rocm":
     #     decomp_attn = True
     #     external_weights = None
     #     print("Decomposing attention and inlining weights for fp32 VAE on ROCm")
-    if device == "cpu":
-        decomp_attn = True
 
+    # For bf16, only the decoder body runs in bf16; the exported function
+    # takes and returns fp32 tensors. fp8 keeps bf16 activations and stores
+    # conv/linear weights as float8_e4m3fn.
     dtype = torch.float16 if precision == "fp16" else torch.float32
     if precision == "fp16":
         vae_model = vae_model.half()
+    elif precision == "bf16":
+        vae_model = vae_model.to(torch.bfloat16)
+    elif precision == "fp8":
+        if target_triple not in _FP8_TARGETS:
+            raise ValueError(
+                f"fp8 VAE weights are only supported for targets {_FP8_TARGETS}"
+            )
+        vae_model = vae_model.to(torch.bfloat16)
+        quantize_weights_fp8(vae_model.vae)
 
     mapper = {}
 
-    if not os.path.exists(external_weight_path):
+    if (
+        external_weights
+        and external_weight_path
+        and not _external_weights_current(vae_model, external_weight_path)
+    ):
+        # save_external_weights never overwrites, so clear a stale file first.
+        if os.path.exists(external_weight_path):
+            print(f"Rewriting stale external weights at {external_weight_path}")
+            os.remove(external_weight_path)
         utils.save_external_weights(
             mapper, vae_model, external_weights, external_weight_path
         )
     if weights_only:
         return external_weight_path
 
-    input_image_shape = (height, width, 3)
+    # The VAE is all 2D convs, so trace it with NHWC-friendly strides.
+    vae_model = vae_model.eval().to(memory_format=torch.channels_last)
+
+    input_image_shape = (batch_size, 3, height, width)
     input_latents_shape = (batch_size, 4, height // 8, width // 8)
+    # Both entrypoints take NCHW tensors laid out channels_last to match the
+    # model, so tracing doesn't insert a layout copy ahead of the first conv.
     encode_args = [
-        torch.empty(
+        torch.zeros(
             input_image_shape,
             dtype=torch.float32,
-        )
+        ).to(memory_format=torch.channels_last)
     ]
     decode_args = [
-        torch.empty(
+        torch.zeros(
             input_latents_shape,
             dtype=dtype,
-        )
+        ).to(memory_format=torch.channels_last)
     ]
-    decomp_list = []
     if decomp_attn == True:
         safe_name += "_decomp"
-        decomp_list = [
-            torch.ops.aten._scaled_dot_product_flash_attention_for_cpu,
-            torch.ops.aten._scaled_dot_product_flash_attention.default,
-            torch.ops.aten.scaled_dot_product_attention,
-        ]
-    with decompositions.extend_aot_decompositions(
+        decomp_ops = _ATTN_DECOMP_OPS
+    elif device == "cpu":
+        decomp_ops = _CPU_DECOMP_OPS
+    else:
+        decomp_ops = ()
+    # Trace without autograd so no detach/version-counter bookkeeping ends
+    # up in the exported graphs.
+    with torch.no_grad(), decompositions.extend_aot_decompositions(
         from_current=True,
-        add_ops=decomp_list,
+        add_ops=decomp_ops,
     ):
         fxb = FxProgramsBuilder(vae_model)
 
-        # @fxb.export_program(args=(encode_args,))
-        # def _encode(module, inputs,):
-        #     return module.encode(*inputs)
+        # The "all" variant exports encode and decode entrypoints from one
+        # import, so both share a single set of weight globals and one vmfb.
+        if variant in ["encode", "all"]:
 
-        @fxb.export_program(args=(decode_args,))
-        def _decode(module, inputs):
-            return module.decode(*inputs)
+            @fxb.export_program(args=(encode_args,))
+            def _encode(module, inputs):
+                return module.encode(*inputs)
+
+        if variant not in ["encode", "encode_decode"]:
+
+            @fxb.export_program(args=(decode_args,))
+            def _decode(module, inputs):
+                return module.decode(*inputs)
+
+        if variant == "encode_decode":
+            # Encode and decode in one program so img2img-style round trips
+            # don't sync through the host between the two halves.
+            @fxb.export_program(args=(encode_args,))
+            def _encode_decode(module, inputs):
+                return module.decode(module.encode(*inputs))
 
         class CompiledVae(CompiledModule):
-            main = _decode
+            if variant == "all":
+                encode = _encode
+                decode = _decode
+            elif variant == "encode":
+                main = _encode
+            elif variant == "encode_decode":
+                main = _encode_decode
+            else:
+                main = _decode
 
         if external_weights:
             externalize_module_parameters(vae_model)
 
         inst = CompiledVae(context=Context(), import_to="IMPORT")
 
-        module_str = str(CompiledModule.get_mlir_module(inst))
+        module = CompiledModule.get_mlir_module(inst)
 
     if compile_to != "vmfb":
-        return module_str
+        return str(module)
     else:
+        # Hand the compiler MLIR bytecode rather than printing the module to
+        # text and having it re-parsed.
+        module_bytecode = io.BytesIO()
+        module.operation.write_bytecode(module_bytecode)
+        module_bytecode = module_bytecode.getvalue()
+        # Identical IR compiled with identical options is served from disk.
+        vmfb_key = utils.get_artifact_cache_key(
+            module_bytecode, device, target_triple, ireec_flags, attn_spec
+        )
+        if not force_rebuild:
+            vmfb_path = utils.get_cached_artifact(pipeline_dir, vmfb_key)
+            if vmfb_path:
+                print("Found cached VAE vmfb:", vmfb_path)
+                return None if exit_on_vmfb else vmfb_path
         vmfb_path = utils.compile_to_vmfb(
-            module_str,
+            module_bytecode,
             device,
             target_triple,
             ireec_flags,
             safe_name + "_" + target_triple,
-            return_path=not exit_on_vmfb,
+            mlir_source="bytecode",
+            return_path=True,
             attn_spec=attn_spec,
         )
-        return vmfb_path
+        utils.cache_artifact(pipeline_dir, vmfb_key, vmfb_path)
+        # Like the input_mlir path, only hand the path back when asked to.
+        return None if exit_on_vmfb else vmfb_path
 
 
 if __name__ == "__main__":
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+    import warnings
     from turbine_models.custom_models.sdxl_inference.sdxl_cmd_opts import args
 
-    if args.precision == "fp16":
-        custom_vae = "madebyollin/sdxl-vae-fp16-fix"
-    else:
-        custom_vae = ""
+    for dim in ["height", "width"]:
+        size = getattr(args, dim)
+        if size % 64 != 0:
+            rounded = -(-size // 64) * 64
+            warnings.warn(
+                f"VAE {dim} {size} is not a multiple of 64; rounding up to {rounded}."
+            )
+            setattr(args, dim, rounded)
 
-    if args.input_mlir:
-        vae_model = None
-    else:
-        vae_model = VaeModel(
-            args.hf_model_name,
-            custom_vae=custom_vae,
-        )
-    mod_str = export_vae_model(
-        vae_model,
-        args.hf_model_name,
-        args.batch_size,
+    def get_custom_vae(variant):
+        if variant == "preview":
+            return "taesdxl"
+        elif args.precision == "fp16":
+            return "madebyollin/sdxl-vae-fp16-fix"
+        return ""
+
+    # --vae_variant may name several comma-separated variants, e.g.
+    # "encode,decode"; each one is exported independently. Repeats are
+    # dropped so no two workers write the same files.
+    variants = list(dict.fromkeys(args.vae_variant.split(",")))
+    export_kwargs = dict(
+        hf_model_name=args.hf_model_name,
+        batch_size=args.batch_size,
         height=args.height,
         width=args.width,
         precision=args.precision,
         compile_to=args.compile_to,
         external_weights=args.external_weights,
-        external_weight_path=args.external_weight_path,
         device=args.device,
         target_triple=args.iree_target_triple,
         ireec_flags=args.ireec_flags + args.attn_flags + args.vae_flags,
-        variant=args.vae_variant,
         decomp_attn=args.decomp_attn,
         attn_spec=args.attn_spec,
         input_mlir=args.input_mlir,
+        force_rebuild=args.force_rebuild,
     )
+    # When variants are backed by different models (preview uses taesdxl),
+    # each model gets its own weights file.
+    mixed_models = len({get_custom_vae(variant) for variant in variants}) > 1
+
+    def get_weight_path(variant):
+        weight_path = args.external_weight_path
+        if weight_path and mixed_models and get_custom_vae(variant) == "taesdxl":
+            root, ext = os.path.splitext(weight_path)
+            weight_path = f"{root}_taesdxl{ext}"
+        return weight_path
+
+    if len(variants) == 1:
+        mod_strs = [
+            export_vae_model(
+                None,
+                variant=variants[0],
+                custom_vae=get_custom_vae(variants[0]),
+                external_weight_path=args.external_weight_path,
+                **export_kwargs,
+            )
+        ]
+    else:
+        if args.external_weight_path and not args.input_mlir:
+            # Write (or refresh) each weights file once up front so the
+            # workers only ever read them.
+            weight_paths = {}
+            for variant in variants:
+                weight_paths.setdefault(get_weight_path(variant), variant)
+            for weight_path, variant in weight_paths.items():
+                export_vae_model(
+                    None,
+                    variant=variant,
+                    custom_vae=get_custom_vae(variant),
+                    external_weight_path=weight_path,
+                    weights_only=True,
+                    **export_kwargs,
+                )
+        # Processes rather than threads: the IREE compiler keeps
+        # process-global LLVM state that isn't safe to share across threads.
+        # Workers are spawned, not forked, so they don't inherit torch's
+        # thread pools or the weights loaded above.
+        max_workers = min(len(variants), max(1, os.cpu_count() // 2))
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    export_vae_model,
+                    None,
+                    variant=variant,
+                    custom_vae=get_custom_vae(variant),
+                    external_weight_path=get_weight_path(variant),
+                    **export_kwargs,
+                )
+                for variant in variants
+            ]
+            mod_strs = [future.result() for future in futures]
     if args.input_mlir or (args.compile_to == "vmfb"):
         exit()
-    safe_name = utils.create_safe_name(
-        args.hf_model_name,
-        f"_bs{str(args.batch_size)}_{args.height}x{args.width}_{args.precision}_vae_{args.vae_variant}",
-    )
-    with open(f"{safe_name}.mlir", "w+") as f:
-        f.write(mod_str)
-    print("Saved to", safe_name + ".mlir")
+    for variant, mod_str in zip(variants, mod_strs):
+        safe_name = utils.create_safe_name(
+            args.hf_model_name,
+            f"_bs{str(args.batch_size)}_{args.height}x{args.width}_{args.precision}_vae_{variant}",
+        )
+        with open(f"{safe_name}.mlir", "w+") as f:
+            f.write(mod_str)
+        print("Saved to", safe_name + ".mlir")
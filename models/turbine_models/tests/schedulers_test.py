@@ -0,0 +1,38 @@
+# Copyright 2024 Advanced Micro Devices, inc.
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+import logging
+import os
+import tempfile
+import unittest
+
+from turbine_models.custom_models.sd_inference import schedulers
+
+
+class SchedulerAOTITest(unittest.TestCase):
+    def testExportSchedulerAOTI(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            so_paths = schedulers.export_scheduler_model(
+                "stabilityai/stable-diffusion-xl-base-1.0",
+                "EulerDiscrete",
+                batch_size=1,
+                height=512,
+                width=512,
+                num_inference_steps=2,
+                precision="fp32",
+                compile_to="aoti",
+                pipeline_dir=tmp_dir,
+            )
+            self.assertEqual(
+                sorted(so_paths), ["run_initialize", "run_scale", "run_step"]
+            )
+            for so_path in so_paths.values():
+                self.assertTrue(os.path.exists(so_path))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,145 @@
+# Copyright 2024 Advanced Micro Devices, inc.
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+import logging
+import os
+import tempfile
+import unittest
+
+from turbine_models.custom_models.sd_inference import utils
+
+
+class ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp_dir.name
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def _make_artifact(self, name, contents=b"vmfb"):
+        path = os.path.join(self.cache_dir, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
+
+    def testCacheHit(self):
+        key = utils.get_artifact_cache_key("model", 1, "gfx942", ["--flag"])
+        path = self._make_artifact("model.vmfb")
+        utils.cache_artifact(self.cache_dir, key, path)
+        self.assertEqual(utils.get_cached_artifact(self.cache_dir, key), path)
+
+    def testCacheMissAfterKeyChange(self):
+        key = utils.get_artifact_cache_key("model", 1, "gfx942", ["--flag"])
+        utils.cache_artifact(self.cache_dir, key, self._make_artifact("model.vmfb"))
+        for changed_key in [
+            utils.get_artifact_cache_key("model", 2, "gfx942", ["--flag"]),
+            utils.get_artifact_cache_key("model", 1, "gfx1100", ["--flag"]),
+            utils.get_artifact_cache_key("model", 1, "gfx942", ["--other"]),
+        ]:
+            self.assertNotEqual(changed_key, key)
+            self.assertIsNone(utils.get_cached_artifact(self.cache_dir, changed_key))
+
+    def testCacheKeyAcceptsBytes(self):
+        self.assertEqual(
+            utils.get_artifact_cache_key(b"module", "cpu"),
+            utils.get_artifact_cache_key("module", "cpu"),
+        )
+
+    def testCacheMissWhenArtifactRemoved(self):
+        key = utils.get_artifact_cache_key("model")
+        path = self._make_artifact("model.vmfb")
+        utils.cache_artifact(self.cache_dir, key, path)
+        os.remove(path)
+        self.assertIsNone(utils.get_cached_artifact(self.cache_dir, key))
+
+    def testCacheMissWithoutIndex(self):
+        key = utils.get_artifact_cache_key("model")
+        self.assertIsNone(utils.get_cached_artifact(self.cache_dir, key))
+
+    def testStaleEntriesPruned(self):
+        old_key = utils.get_artifact_cache_key("model", ["--old"])
+        new_key = utils.get_artifact_cache_key("model", ["--new"])
+        other_key = utils.get_artifact_cache_key("other")
+        path = self._make_artifact("model.vmfb")
+        other_path = self._make_artifact("other.vmfb")
+        utils.cache_artifact(self.cache_dir, old_key, path)
+        utils.cache_artifact(self.cache_dir, other_key, other_path)
+        # Rebuilding the same artifact under a new key invalidates the old one.
+        utils.cache_artifact(self.cache_dir, new_key, path)
+        self.assertIsNone(utils.get_cached_artifact(self.cache_dir, old_key))
+        self.assertEqual(utils.get_cached_artifact(self.cache_dir, new_key), path)
+        self.assertEqual(
+            utils.get_cached_artifact(self.cache_dir, other_key), other_path
+        )
+        # The index is replaced atomically, so no temporary files remain.
+        self.assertEqual(
+            sorted(os.listdir(self.cache_dir)),
+            ["artifact_cache.json", "model.vmfb", "other.vmfb"],
+        )
+
+
+class UtilsTest(unittest.TestCase):
+    def testMergeIreecFlags(self):
+        defaults = [
+            "--iree-opt-const-eval=false",
+            "--iree-opt-data-tiling=false",
+            "--iree-flow-enable-aggressive-fusion",
+        ]
+        merged = utils.merge_ireec_flags(
+            defaults,
+            [
+                " --iree-opt-const-eval=true",
+                "--iree-opt-data-tiling=None",
+                "",
+                "--iree-codegen-gpu-native-math-precision=true",
+            ],
+        )
+        # Overrides keep the default's position; new flags are appended.
+        self.assertEqual(
+            merged,
+            [
+                "--iree-opt-const-eval=true",
+                "--iree-flow-enable-aggressive-fusion",
+                "--iree-codegen-gpu-native-math-precision=true",
+            ],
+        )
+
+    def testMergeIreecFlagsLastUserFlagWins(self):
+        merged = utils.merge_ireec_flags(
+            ["--iree-opt-const-eval=false"],
+            ["--iree-opt-const-eval=true", "--iree-opt-const-eval=false"],
+        )
+        self.assertEqual(merged, ["--iree-opt-const-eval=false"])
+
+    def testWriteVmfb(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "model.vmfb")
+            blob = bytes(range(256)) * 4096
+            utils.write_vmfb(path, blob)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), blob)
+            # Rewriting with a shorter blob truncates the old contents.
+            utils.write_vmfb(path, b"short")
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), b"short")
+
+    def testCreateSafeName(self):
+        self.assertEqual(
+            utils.create_safe_name(
+                "stabilityai/stable-diffusion-xl-base-1.0", "_bs1_1024x1024_fp16"
+            ),
+            "stable_diffusion_xl_base_1_0_bs1_1024x1024_fp16",
+        )
+        self.assertEqual(
+            utils.create_safe_name("org/model-v1.5", "vae"), "model_v1_5_vae"
+        )
+        self.assertEqual(utils.create_safe_name("org/model-v1.5"), "model_v1_5")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()
@@ -0,0 +1,109 @@
+# Copyright 2024 Advanced Micro Devices, inc.
+#
+# Licensed under the Apache License v2.0 with LLVM Exceptions.
+# See https://llvm.org/LICENSE.txt for license information.
+# SPDX-License-Identifier: Apache-2.0 WITH LLVM-exception
+
+import logging
+import unittest
+
+import torch
+from turbine_models.custom_models.sdxl_inference import vae
+
+
+class Fp8WeightLayerTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def _check_layer(self, layer, x):
+        fp8_layer = vae.Fp8WeightLayer(layer)
+        # Weights are parameters so they get externalized with the rest.
+        params = dict(fp8_layer.named_parameters())
+        self.assertEqual(params["weight"].dtype, torch.float8_e4m3fn)
+        self.assertEqual(params["scale"].dtype, layer.weight.dtype)
+        self.assertFalse(any(p.requires_grad for p in fp8_layer.parameters()))
+        self.assertEqual(dict(fp8_layer.named_buffers()), {})
+
+        with torch.no_grad():
+            expected = layer(x)
+            actual = fp8_layer(x)
+        self.assertEqual(actual.dtype, expected.dtype)
+        # e4m3 keeps 3 mantissa bits, i.e. up to 1/16 relative error per
+        # weight, which mostly averages out over the reduction.
+        torch.testing.assert_close(
+            actual, expected, rtol=0.1, atol=0.1 * expected.abs().max().item()
+        )
+
+    def testLinear(self):
+        self._check_layer(torch.nn.Linear(64, 32), torch.randn(4, 64))
+
+    def testConv2d(self):
+        self._check_layer(
+            torch.nn.Conv2d(8, 16, kernel_size=3, stride=1, padding=1),
+            torch.randn(2, 8, 16, 16),
+        )
+
+    def testStridedConv2dNoBias(self):
+        self._check_layer(
+            torch.nn.Conv2d(8, 8, kernel_size=3, stride=2, padding=1, bias=False),
+            torch.randn(2, 8, 16, 16),
+        )
+
+    def testQuantizeWeightsFp8(self):
+        model = torch.nn.Sequential(
+            torch.nn.Conv2d(4, 4, kernel_size=1),
+            torch.nn.GroupNorm(2, 4),
+            torch.nn.Sequential(torch.nn.Linear(4, 4)),
+        )
+        vae.quantize_weights_fp8(model)
+        self.assertIsInstance(model[0], vae.Fp8WeightLayer)
+        self.assertIsInstance(model[1], torch.nn.GroupNorm)
+        self.assertIsInstance(model[2][0], vae.Fp8WeightLayer)
+
+
+class _Decode(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, latents):
+        return self.model.decode(latents, return_dict=False)[0]
+
+
+class VaeTilingTest(unittest.TestCase):
+    def _export_decode(self, tiled):
+        from diffusers import AutoencoderKL
+
+        torch.manual_seed(0)
+        model = AutoencoderKL(
+            down_block_types=("DownEncoderBlock2D",) * 2,
+            up_block_types=("UpDecoderBlock2D",) * 2,
+            block_out_channels=(8, 16),
+            layers_per_block=1,
+            norm_num_groups=8,
+            latent_channels=4,
+            sample_size=32,
+        ).eval()
+        if tiled:
+            vae.enable_vae_tiling(model, tile_sample_size=64)
+        # 48x48 latents are larger than the 32x32 latent tiles above.
+        latents = torch.randn(1, 4, 48, 48)
+        with torch.no_grad():
+            return torch.export.export(_Decode(model), (latents,))
+
+    def _count_convolutions(self, exported):
+        conv_ops = [torch.ops.aten.convolution.default, torch.ops.aten.conv2d.default]
+        return sum(node.target in conv_ops for node in exported.graph.nodes)
+
+    def testTiledDecodeGraphDiffers(self):
+        monolithic = self._export_decode(tiled=False)
+        tiled = self._export_decode(tiled=True)
+        # Each tile runs its own copy of the decoder convs.
+        self.assertGreater(
+            self._count_convolutions(tiled), self._count_convolutions(monolithic)
+        )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    unittest.main()